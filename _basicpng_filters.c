@@ -0,0 +1,155 @@
+/*
+ * Copyright (c) 2024, Vlad Meșco
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ * DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+ * FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+ * DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ * CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+ * OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+ * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+ */
+/*
+ * Optional C versions of the four PNG scanline filters, for basicpng.
+ *
+ * basicpng works just fine without this; if it's been built (see setup.py),
+ * PngDecode.decompress picks it up and stops defiltering in Python.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+/*
+ * Decodes row in place. prev is the decoded row above (all zeros for the
+ * first row), bpp is how far to the left the "left" byte is.
+ *
+ * The loops are kept dead simple so the compiler can vectorize what it can:
+ * Up has no dependencies at all, and Sub only chains bytes bpp apart.
+ */
+static void defilter_row(uint8_t *row, const uint8_t *prev, size_t len, size_t bpp, int ftype)
+{
+    size_t i;
+
+    switch(ftype) {
+    case 1: /* Sub */
+        for(i = bpp; i < len; ++i) {
+            row[i] += row[i - bpp];
+        }
+        break;
+    case 2: /* Up */
+#if defined(__GNUC__) && !defined(__clang__)
+#pragma GCC ivdep
+#endif
+        for(i = 0; i < len; ++i) {
+            row[i] += prev[i];
+        }
+        break;
+    case 3: /* Average */
+        for(i = 0; i < bpp && i < len; ++i) {
+            row[i] += prev[i] >> 1;
+        }
+        for(i = bpp; i < len; ++i) {
+            row[i] += (uint8_t)(((unsigned)row[i - bpp] + prev[i]) >> 1);
+        }
+        break;
+    case 4: /* Paeth */
+        for(i = 0; i < bpp && i < len; ++i) {
+            /* a = c = 0, so the predictor picks b */
+            row[i] += prev[i];
+        }
+        for(i = bpp; i < len; ++i) {
+            /* PaethPredictor, inlined */
+            int a = row[i - bpp];
+            int b = prev[i];
+            int c = prev[i - bpp];
+            int pa = abs(b - c);
+            int pb = abs(a - c);
+            int pc = abs(a + b - c - c);
+            if(pa <= pb && pa <= pc) {
+                row[i] += (uint8_t)a;
+            } else if(pb <= pc) {
+                row[i] += (uint8_t)b;
+            } else {
+                row[i] += (uint8_t)c;
+            }
+        }
+        break;
+    default: /* None */
+        break;
+    }
+}
+
+PyDoc_STRVAR(defilter_doc,
+"defilter(cur, prev, bpp, ftype)\n"
+"\n"
+"Undoes PNG filter type ftype (0..4) on the raw scanline cur, given the\n"
+"already decoded scanline prev above it. bpp is the filter's byte offset\n"
+"to the left. Returns the decoded scanline as bytes.");
+
+static PyObject *defilter(PyObject *self, PyObject *args)
+{
+    Py_buffer cur, prev;
+    Py_ssize_t bpp;
+    int ftype;
+    PyObject *rval = NULL;
+
+    if(!PyArg_ParseTuple(args, "y*y*ni", &cur, &prev, &bpp, &ftype)) {
+        return NULL;
+    }
+
+    if(ftype < 0 || ftype > 4) {
+        PyErr_Format(PyExc_ValueError, "Non standard filter type %d", ftype);
+    } else if(bpp < 1) {
+        PyErr_SetString(PyExc_ValueError, "bpp must be at least 1");
+    } else if(prev.len < cur.len) {
+        PyErr_SetString(PyExc_ValueError, "prev is shorter than cur");
+    } else {
+        /* Not PyBytes_FromStringAndSize(cur.buf, ...): one byte long
+         * strings are shared singletons, and we are about to write into it */
+        rval = PyBytes_FromStringAndSize(NULL, cur.len);
+        if(rval != NULL) {
+            uint8_t *row = (uint8_t *)PyBytes_AS_STRING(rval);
+            Py_BEGIN_ALLOW_THREADS
+            memcpy(row, cur.buf, (size_t)cur.len);
+            defilter_row(row, (const uint8_t *)prev.buf, (size_t)cur.len, (size_t)bpp, ftype);
+            Py_END_ALLOW_THREADS
+        }
+    }
+
+    PyBuffer_Release(&cur);
+    PyBuffer_Release(&prev);
+    return rval;
+}
+
+static PyMethodDef methods[] = {
+    {"defilter", defilter, METH_VARARGS, defilter_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "_basicpng_filters",
+    "C versions of basicpng's PNG scanline filters.",
+    -1,
+    methods
+};
+
+PyMODINIT_FUNC PyInit__basicpng_filters(void)
+{
+    return PyModule_Create(&module);
+}
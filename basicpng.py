@@ -35,7 +35,32 @@ at their full fidelity. Sorry, but you get them downsampled to 24bit.
 """
 import zlib
 import os
-import math
+import itertools
+import functools
+
+try:
+    # Optional. The filters written in C, built from _basicpng_filters.c
+    # with `python setup.py build_ext --inplace`.
+    import _basicpng_filters
+except ImportError:
+    _basicpng_filters = None
+
+numba = None
+if _basicpng_filters is None:
+    try:
+        # Optional, and only worth looking for if the C filters aren't
+        # around. If numba (and hence numpy) happens to be installed, the
+        # row filters get compiled; otherwise everything stays in plain Python.
+        import numba
+        import numpy
+    except ImportError:
+        numba = None
+
+try:
+    # Optional. libdeflate inflates about twice as fast as zlib does.
+    import deflate
+except ImportError:
+    deflate = None
 
 def PaethPredictor(a, b, c):
     """
@@ -57,27 +82,54 @@ def PaethPredictor(a, b, c):
     else:
         return c
 
-def Clamp(x):
+def AddBytes(a, b):
     """
-    Ensures x is within 0 and 255, and that it is an int()
-    """
-    x = int(round(x))
-    if x >= 0 and x <= 255:
-        return x
-    elif x < 0:
-        return 0
-    else:
-        return 255
+    Adds two equally long byte strings together, byte by byte, modulo 256.
 
-def GetNormalizer(bits_per_channel, is_indexed):
+    Rather than looping, both strings are turned into one huge int and added
+    in a single go. The top bit of each byte is kept out of the addition so
+    that carries never spill into the neighbouring byte, and is put back in
+    with a xor afterwards (a xor is an addition which forgets the carry).
     """
-    Returns a lambda which normalizes a number of < 8 bits wide to fill the
-    0..255 range as if it were a full byte.
+    n = len(a)
+    lo = int.from_bytes(b"\x7F" * n, "little")
+    hi = int.from_bytes(b"\x80" * n, "little")
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    return (((x & lo) + (y & lo)) ^ ((x ^ y) & hi)).to_bytes(n, "little")
+
+# Normalizes a number of < 8 bits wide to fill the 0..255 range as if it were
+# a full byte, for every sub-byte bit depth, indexed or not. Indexes into the
+# PLTE block are left untouched. The largest value is 1, 3 or 15, all of which
+# divide 255, so scaling is an exact integer multiplication.
+NORM_TABLES = {
+    (bits_per_channel, is_indexed): bytes(
+        x if is_indexed else x * (255 // ((1 << bits_per_channel) - 1))
+        for x in range(0, 1 << bits_per_channel)
+    )
+    for bits_per_channel in (1, 2, 4)
+    for is_indexed in (False, True)
+}
+
+def ExplodeByte(bb, bits_per_channel, is_indexed):
     """
-    if is_indexed:
-        return lambda x: x
-    else:
-        return lambda x: Clamp(x / float((1 << bits_per_channel) - 1) * 255.0)
+    Splits a single byte into its 1, 2 or 4 bit wide channels, most
+    significant first, and normalizes each of them (see NORM_TABLES).
+    """
+    normalized = NORM_TABLES[(bits_per_channel, is_indexed)]
+    mask = (1 << bits_per_channel) - 1
+    return bytes([
+        normalized[(bb >> shift) & mask]
+        for shift in range(8 - bits_per_channel, -1, -bits_per_channel)
+    ])
+
+# What each of the 256 byte values explodes into, for every sub-byte
+# bit depth, indexed or not. There are only 6 * 256 of them.
+EXPLODE_TABLES = {
+    (bits_per_channel, is_indexed): [ExplodeByte(bb, bits_per_channel, is_indexed) for bb in range(0, 256)]
+    for bits_per_channel in (1, 2, 4)
+    for is_indexed in (False, True)
+}
 
 def ExplodeBytes(data, bits_per_channel, is_indexed):
     """
@@ -94,41 +146,61 @@ def ExplodeBytes(data, bits_per_channel, is_indexed):
     if bits_per_channel == 8:
         return data
 
-    rval = bytearray([])
     if bits_per_channel == 16:
-        for i in range(0, len(data) / 2):
+        rval = bytearray([])
+        for i in range(0, len(data) // 2):
             # Use the lower byte to determine if we need to round up
             b2 = data[2*i+1]
             # But mostly use the high byte
-            b1 = data[2*i+0] if b2 < 128 else Clamp(data[2*i+0] + 1)
+            b1 = data[2*i+0] if b2 < 128 else min(data[2*i+0] + 1, 255)
             rval.append(b1)
-    elif bits_per_channel == 4:
-        normalizer = GetNormalizer(is_indexed, 4)
-        for i in range(0, len(data)):
-            bb = data[i]
-            rval.append(normalizer((bb & 0xF0) >> 4))
-            rval.append(normalizer((bb & 0x0F) >> 0))
-    elif bits_per_channel == 2:
-        normalizer = GetNormalizer(is_indexed, 2)
-        for i in range(0, len(data)):
-            bb = data[i]
-            rval.append(normalizer((bb & 0xC0) >> 6))
-            rval.append(normalizer((bb & 0x30) >> 4))
-            rval.append(normalizer((bb & 0x0C) >> 2))
-            rval.append(normalizer((bb & 0x03) >> 0))
-    elif bits_per_channel == 1:
-        normalizer = GetNormalizer(is_indexed, 1)
-        for i in range(0, len(data)):
-            bb = data[i]
-            rval.append(normalizer((bb & 0x80) >> 7))
-            rval.append(normalizer((bb & 0x40) >> 6))
-            rval.append(normalizer((bb & 0x20) >> 5))
-            rval.append(normalizer((bb & 0x10) >> 4))
-            rval.append(normalizer((bb & 0x08) >> 3))
-            rval.append(normalizer((bb & 0x04) >> 2))
-            rval.append(normalizer((bb & 0x02) >> 1))
-            rval.append(normalizer((bb & 0x01) >> 0))
-    return rval
+        return rval
+
+    # Every byte explodes into the same 8, 4 or 2 output bytes no matter
+    # where it sits, so just look them up.
+    return b"".join(map(EXPLODE_TABLES[(bits_per_channel, is_indexed)].__getitem__, data))
+
+if numba is not None:
+    # The same filters as in PngDecode.decompress, but written the way a C
+    # programmer would, one byte at a time, since numba compiles them to
+    # exactly that. They all decode row in place; prior is the decoded row
+    # above, and bpp is how far to the left the "left" byte is.
+
+    @numba.njit(cache=True)
+    def ApplySub(row, prior, bpp):
+        for i in range(bpp, row.shape[0]):
+            row[i] += row[i - bpp]
+
+    @numba.njit(cache=True)
+    def ApplyAverage(row, prior, bpp):
+        for i in range(0, row.shape[0]):
+            left = numba.int32(row[i - bpp]) if i >= bpp else 0
+            row[i] += numba.uint8((left + numba.int32(prior[i])) >> 1)
+
+    @numba.njit(cache=True)
+    def ApplyPaeth(row, prior, bpp):
+        for i in range(0, row.shape[0]):
+            # PaethPredictor, inlined
+            a = numba.int32(row[i - bpp]) if i >= bpp else 0
+            b = numba.int32(prior[i])
+            c = numba.int32(prior[i - bpp]) if i >= bpp else 0
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                row[i] += numba.uint8(a)
+            elif pb <= pc:
+                row[i] += numba.uint8(b)
+            else:
+                row[i] += numba.uint8(c)
+
+    # No Up here: AddBytes already does a whole row in one go, and beats
+    # copying the row into numpy just to call a kernel on it.
+    NUMBA_FILTERS = {
+        1: ApplySub,
+        3: ApplyAverage,
+        4: ApplyPaeth,
+    }
 
 class EndReading(Exception):
     """
@@ -161,9 +233,18 @@ class PngDecode:
         # decoded bytes
         self.rgba = bytearray([])
         # all IDAT chunks, which are one long deflate stream
-        self.idat_data = bytearray([])
+        self.idat_chunks = []
         # PLTE table
         self.palette = None
+        # the whole image as RGBA8, see get()
+        self.rgba8 = None
+        # the chunks we know what to do with, by their id
+        self.handlers = {
+            b"IHDR": self.IHDR,
+            b"PLTE": self.PLTE,
+            b"IDAT": self.IDAT,
+            b"IEND": self.IEND,
+        }
         #print(f"Parsing {fname}")
         self.parse(fname)
         #print(f"Done parsing {fname}")
@@ -223,7 +304,9 @@ class PngDecode:
         need to fetch all of them, since it's one big DEFLATE stream
         """
         #print("Saving IDAT")
-        self.idat_data.extend(bchd)
+        # Just keep them as they are; decompress feeds them to zlib one by one,
+        # so there's no point in gluing them together first
+        self.idat_chunks.append(bchd)
 
     def PLTE(self, bchd):
         """
@@ -231,176 +314,308 @@ class PngDecode:
         care to enforce that rule.
         """
         sz = len(bchd) // 3
-        if sz == 0 or sz > 255:
+        if sz == 0 or sz > 256:
+            return
+        # Keep it as it is, RGB RGB RGB...; entry i starts at byte 3*i
+        self.palette = bytes(bchd[:sz*3])
+
+    def scanlines(self, www):
+        """
+        Decompresses the IDAT stream and yields it one www bytes long
+        scanline at a time, as soon as each one has been inflated.
+        """
+        if deflate is not None:
+            # libdeflate only does whole buffers at a time, which is fine,
+            # since we know exactly how big the output is going to be.
+            # A broken stream raises deflate.DeflateError; let it.
+            ddat = memoryview(deflate.zlib_decompress(b"".join(self.idat_chunks), self.h * www))
+            for j in range(0, len(ddat) // www):
+                yield ddat[j * www:(j+1) * www]
             return
-        # The value from IDAT will index this array directly
-        self.palette = []
-        for i in range(0, sz):
-            self.palette.append([bchd[3*i+0], bchd[3*i+1], bchd[3*i+2]])
 
-    def decompress(self):
-        #print("Parsing all IDAT chunks")
         # PNG implicitly specifies DEFLATE + 32767, so let's create an object; the defaults to decompressobj are 2^15 and no custom dictionary, which will do
         zlibd = zlib.decompressobj()
-        ddat = zlibd.decompress(self.idat_data)
-
-        #print(f"   len(ddat)={len(ddat)}")
+        # Only ever inflate a few rows' worth at a time (or 64k, for narrow
+        # images), and hand them out before inflating more, so that the whole
+        # decompressed image never needs to be around at once.
+        max_length = max(www * 8, 65536)
+        buf = bytearray()
+        for chunk in self.idat_chunks:
+            # Whatever decompress doesn't get to is copied into a brand new
+            # unconsumed_tail every time; feed big chunks in 32k slices so
+            # that copy stays small, instead of redoing most of the chunk.
+            chunk = memoryview(chunk)
+            for pos in range(0, len(chunk), 32768):
+                data = chunk[pos:pos+32768]
+                while len(data) > 0:
+                    buf += zlibd.decompress(data, max_length)
+                    data = zlibd.unconsumed_tail
+                    while len(buf) >= www:
+                        yield buf[:www]
+                        del buf[:www]
+        buf += zlibd.flush()
+        while len(buf) >= www:
+            yield buf[:www]
+            del buf[:www]
 
+    def decompress(self):
         # h rows
         # rows have a filter byte (since there is only one filter method in existance, and this is its spec) and w * bit_depth * num_channels subpixels
         # Note, alpha may be encoded as a magic color specified by a magic CHUNK; we don't care about that
         num_channels = self.num_channels
-        # assumed to be an integer multiple of a byte
         bit_depth = self.bit_depth
         is_indexed = self.color_type == 3
-        #www = self.w * num_channels + 1
-        www = int((self.w * num_channels * bit_depth / 8) + 1)
-        for j in range(0, self.h):
-            # grab a scaline
-            brow = ddat[j * www:(j+1) * www]
+        # Rows of < 8 bit samples are padded up to a whole byte, so round
+        # up; plus one byte for the filter type
+        row_stride = (self.w * num_channels * bit_depth + 7) // 8
+        www = row_stride + 1
+
+        # decoded rows are always 8 bits per channel, so we know exactly how
+        # big the output will be; allocate it once and fill it in row by row
+        # rather than growing it a byte at a time
+        row_len = self.w * num_channels
+        self.rgba = bytearray(self.h * row_len)
+        cur = 0
+        # The filters work on the raw bytes of the scanline, before they get
+        # exploded to 8 bits per channel. The "left" byte is the matching
+        # byte of the previous pixel, or simply the previous byte when a pixel
+        # is smaller than a byte.
+        bpp = max(1, num_channels * bit_depth // 8)
+        # the previous raw decoded row, which Up, Average and Paeth look at;
+        # the row "above" the first one is all zeros
+        prior = bytes(row_stride)
+        # 8 bit data needs no exploding, so don't even call ExplodeBytes for it
+        if bit_depth == 8:
+            explode = lambda d: d
+        else:
+            explode = functools.partial(ExplodeBytes, bits_per_channel=bit_depth, is_indexed=is_indexed)
+        #print("Parsing all IDAT chunks")
+        # rows are defiltered as soon as they come out of inflate
+        rows = 0
+        for j, brow in zip(range(0, self.h), self.scanlines(www)):
             # figure out how the heck it's encoded.
             # The way they did this is pretty smart, as it gets solids and gradients to result in values clustered around 0, making DEFLATE much more efficient!
             filter_subtype = brow[0]
             #print(f"    Row {j+1}/{self.h}: {filter_subtype}")
+            # the memoryview saves making a temporary for brow[1:]; for 8 bit
+            # data None rows are copied straight out of the scanline
+            data = memoryview(brow)[1:]
             if filter_subtype == 0:
                 # None. Just push the bytes in the output array
                 #print(f"    Row {j+1}/{self.h}: No filtering")
-                self.rgba.extend(ExplodeBytes(brow[1:], bit_depth, is_indexed))
-            elif filter_subtype == 1:
+                buffer = data
+            elif _basicpng_filters is not None and filter_subtype in (1, 2, 3, 4):
+                # C versions of the filters below
+                buffer = _basicpng_filters.defilter(data, prior, bpp, filter_subtype)
+            elif numba is not None and filter_subtype in NUMBA_FILTERS:
+                # Compiled versions of the filters below
+                row = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+                NUMBA_FILTERS[filter_subtype](row, numpy.frombuffer(prior, dtype=numpy.uint8), bpp)
+                # carry on with plain Python ints from here on
+                buffer = memoryview(row)
+            elif filter_subtype == 1 or (filter_subtype == 4 and j == 0):
                 # Sub. The byte was encoded as a difference from the byte to the left
+                # (Paeth on the first row is Sub too: with b = c = 0 above,
+                # the predictor always picks a, the byte to the left)
                 # All nonexisting bytes are considered 0.
                 # Note: none of the filters care about bits per channel, they all work on 8bit bytes
                 #print(f"    Row {j+1}/{self.h}: Sub")
-                bpp = self.num_channels
-                buffer = bytearray([0, 0, 0, 0, 0, 0, 0, 0]) + ExplodeBytes(brow[1:], bit_depth, is_indexed)
-                for i in range(0, len(brow)-1):
-                    decoded = ( buffer[i+8] + buffer[i+8-bpp] )%256
-                    buffer[i+8] = decoded
-                    self.rgba.append(decoded)
+                # Each channel is an independent running sum of its own stride,
+                # so let itertools.accumulate do the adding in C, one stride at
+                # a time, instead of walking the row byte by byte.
+                # The sums grow past 255; masking them off afterwards is the
+                # same as doing every addition modulo 256.
+                buffer = bytearray(data)
+                for c in range(0, bpp):
+                    buffer[c::bpp] = bytes(map((0xFF).__and__, itertools.accumulate(buffer[c::bpp])))
             elif filter_subtype == 2:
                 # Up. The byte was encoded as a difference from the byte above
                 #print(f"    Row {j+1}/{self.h}: Up")
-                prior = self.rgba[-(self.w * self.num_channels):]
-                buffer = ExplodeBytes(brow[1:], bit_depth, is_indexed)
-                if len(prior) == 0:
-                    prior = bytes([0] * len(brow)-1)
-                for i in range(0, len(brow)-1):
-                    decoded = ( buffer[i] + prior[i] )%256
-                    self.rgba.append(decoded)
+                # No byte depends on its neighbours, so the whole row can be
+                # added to the one above it at once.
+                buffer = AddBytes(data, prior)
             elif filter_subtype == 3:
                 # Average. The byte was encoded as a difference from the average of the byte to the left and the byte above
                 #print(f"    Row {j+1}/{self.h}: Average")
-                bpp = self.num_channels
-                prior = bytes([0, 0, 0, 0, 0, 0, 0, 0]) + self.rgba[-(self.w * self.num_channels):]
-                if len(prior) == 0:
-                    prior = bytes([0] * (8+len(brow)-1))
-                buffer = bytearray([0, 0, 0, 0, 0, 0, 0, 0]) + ExplodeBytes(brow[1:], bit_depth, is_indexed)
-                for i in range(0, len(brow)-1):
-                    decoded = ( buffer[i+8] + int(math.floor((buffer[i+8-bpp]+prior[i+8])/2)) )%256
-                    buffer[i+8] = decoded
-                    self.rgba.append(decoded)
+                # The byte above can be fetched up front, but the byte to the left
+                # has to be decoded first. That only chains bytes of the same
+                # channel together though, so walk one channel's stride at a time
+                # and keep the left byte in a local instead of indexing for it.
+                buffer = bytearray(data)
+                for c in range(0, bpp):
+                    decoded = bytearray()
+                    left = 0
+                    for x, up in zip(buffer[c::bpp], prior[c::bpp]):
+                        left = (x + ((left + up) >> 1)) & 0xFF
+                        decoded.append(left)
+                    buffer[c::bpp] = decoded
             elif filter_subtype == 4:
                 # Paeth predictor used to encode byte. Google it.
                 # We just need to add the prediction back to decode our byte.
                 # This muxes the bytes to the left, above, and up-left
                 #print(f"    Row {j+1}/{self.h}: Paeth")
-                bpp = self.num_channels
-                prior = bytes([0, 0, 0, 0, 0, 0, 0, 0]) + self.rgba[-(self.w * self.num_channels):]
-                if len(prior) == 0:
-                    prior = bytes([0] * (8+len(brow)-1))
-                buffer = bytearray([0, 0, 0, 0, 0, 0, 0, 0]) + ExplodeBytes(brow[1:], bit_depth, is_indexed)
-                for i in range(0, len(brow)-1):
-                    decoded = ( buffer[i+8] + PaethPredictor(buffer[i+8-bpp], prior[i+8], prior[i+8-bpp]) )%256
-                    buffer[i+8] = decoded
-                    self.rgba.append(decoded)
+                # Same trick as Average: channels don't depend on each other,
+                # so walk one stride at a time, carrying left (a) and
+                # up-left (c) in locals. The predictor is PaethPredictor
+                # inlined, with p already subtracted out of pa, pb and pc:
+                # pa = |b - c|, pb = |a - c|, pc = |(b - c) + (a - c)|
+                buffer = bytearray(data)
+                for ch in range(0, bpp):
+                    decoded = bytearray()
+                    a = 0
+                    c = 0
+                    for x, b in zip(buffer[ch::bpp], prior[ch::bpp]):
+                        pa = b - c
+                        pb = a - c
+                        pc = abs(pa + pb)
+                        pa = abs(pa)
+                        pb = abs(pb)
+                        if pa <= pb and pa <= pc:
+                            a = (x + a) & 0xFF
+                        elif pb <= pc:
+                            a = (x + b) & 0xFF
+                        else:
+                            a = (x + c) & 0xFF
+                        c = b
+                        decoded.append(a)
+                    buffer[ch::bpp] = decoded
             else:
                 raise Exception(f"Non standard filter type {filter_subtype}")
 
+            # Sub-byte rows may end in a few padding bits, which explode into
+            # bogus channels past row_len; those get cut off here.
+            self.rgba[cur:cur + row_len] = memoryview(explode(buffer))[:row_len]
+            cur += row_len
+            # hang on to this row rather than slicing it back out of rgba
+            prior = buffer
+            rows += 1
+
+        if rows < self.h:
+            raise Exception(f"Image data ends after {rows} of {self.h} scanlines; truncated or corrupt IDAT stream?")
+
     def IEND(self, bchd):
         """IEND appears last, and marks the end of the PNG stream"""
         #print("Parsing IEND")
         raise EndReading()
 
     def parse(self, fname):
+        # Read the whole thing in one go; the chunks are then just views
+        # into it, rather than a handful of small reads each
         with open(fname, "rb") as f:
-            # Header is always .PNG.... ; per Spec.
-            # The first byte marks issues with the MBS being reset.
-            # Together with the next three bytes detect issues with
-            # endianness, and mark the file as a PNG file.
-            # The remaining four bytes detect issues with omitting
-            # whitespace, or of \r\n and \n being converted form one
-            # to another. Yes, this is the definition of magic bytes :-)
-            hdr = f.read(8)
-            if hdr != bytes([137, 80, 78, 71, 13, 10, 26, 10]):
-                raise Exception(f"{fname} corrupt or not a png?")
-
-            try:
-                # read until we have a reason to exit
-                while True:
-                    # Each chunk is u32be size, u8[4] id, u8[size] data, u32be crc32
-                    # The id uses bit 5 as special flags which I don't care about.
-                    # If you don't know your ASCII, bit 5 is what makes letters uppercase.
-
-                    # chunk length                    
-                    blen = f.read(4)
-                    if len(blen) < 4:
-                        # EOF probably
-                        #print("Nothing more to read, exiting")
-                        raise EndReading()
-                    dlen = int.from_bytes(blen, "big")
-                    # chunk name / id / type
-                    # first byte, bit 5: unset = critical for display
-                    # second byte, bit 5: set = application private chunk, irrelevant
-                    # third byte, bit 5: reserved, irrelevant
-                    # fourth byte, bit 5: of relevance only to PNG editors, so... irrelevant
-                    # You can see that we ignore some critical chunks, such as PLTE (indexed color)
-                    bcht = f.read(4)
-                    scht = bcht.decode('utf-8')
-                    # Chunk data. dlen bytes
-                    bchd = f.read(dlen) if dlen > 0 else bytes([])
-                    # CRC32
-                    # Don't care about CRC, assume file got "transmitted correctly"
-                    bcrc = f.read(4)
-
-                    #print(f"Found {scht} len={dlen}")
-
-                    # If we have a handler for a chunk type, handle it.
-                    if scht.upper() in dir(self):
-                        getattr(self, scht.upper())(bchd)
-            except EndReading:
-                # pat ourselves on the back for getting through to the
-                # end of the file, and start decoding the IDAT stream
-                self.decompress()
-
-    def get(self, x, y):
+            data = memoryview(f.read())
+
+        # Header is always .PNG.... ; per Spec.
+        # The first byte marks issues with the MBS being reset.
+        # Together with the next three bytes detect issues with
+        # endianness, and mark the file as a PNG file.
+        # The remaining four bytes detect issues with omitting
+        # whitespace, or of \r\n and \n being converted form one
+        # to another. Yes, this is the definition of magic bytes :-)
+        hdr = data[0:8]
+        if hdr != bytes([137, 80, 78, 71, 13, 10, 26, 10]):
+            raise Exception(f"{fname} corrupt or not a png?")
+        pos = 8
+
+        try:
+            # read until we have a reason to exit
+            while True:
+                # Each chunk is u32be size, u8[4] id, u8[size] data, u32be crc32
+                # The id uses bit 5 as special flags which I don't care about.
+                # If you don't know your ASCII, bit 5 is what makes letters uppercase.
+
+                # chunk length
+                blen = data[pos:pos+4]
+                pos += 4
+                if len(blen) < 4:
+                    # EOF probably
+                    #print("Nothing more to read, exiting")
+                    raise EndReading()
+                dlen = int.from_bytes(blen, "big")
+                # chunk name / id / type
+                # first byte, bit 5: unset = critical for display
+                # second byte, bit 5: set = application private chunk, irrelevant
+                # third byte, bit 5: reserved, irrelevant
+                # fourth byte, bit 5: of relevance only to PNG editors, so... irrelevant
+                # You can see that we ignore some critical chunks, such as PLTE (indexed color)
+                bcht = bytes(data[pos:pos+4])
+                pos += 4
+                # Chunk data. dlen bytes
+                bchd = data[pos:pos+dlen]
+                pos += dlen
+                # CRC32
+                # Don't care about CRC, assume file got "transmitted correctly"
+                bcrc = data[pos:pos+4]
+                pos += 4
+
+                #print(f"Found {bcht} len={dlen}")
+
+                # If we have a handler for a chunk type, handle it.
+                handler = self.handlers.get(bcht)
+                if handler is not None:
+                    handler(bchd)
+        except EndReading:
+            # pat ourselves on the back for getting through to the
+            # end of the file, and start decoding the IDAT stream
+            self.decompress()
+
+    def to_rgba8(self):
         """
-        Retrieve the RGBA8 values at x x y.
+        Converts the whole image to RGBA8 in one go.
 
-        Returns tuple(r, g, b, a)
+        Returns bytes, w * h * 4 long, row after row, 4 bytes per pixel.
 
-        Check this.w and this.h for size
+        This is what get() looks pixels up in. If you're going to walk the
+        whole image anyway, you may as well take this and index it yourself.
         """
-        ww = self.num_channels
-        www = self.w * ww
-        start = y * www + x * ww
-        pixel = self.rgba[start:start+self.num_channels]
+        n = self.w * self.h
+        rgba = self.rgba
+        opaque = b"\xFF" * n
 
-        # if indexed, grab the RGB values from the palette
+        # if indexed, grab the RGB values from the palette; it's
+        # already padded with an opaque alpha, so each lookup is a pixel
         if self.color_type == 3:
-            pixel = self.palette[pixel[0]]
+            palette = [self.palette[i:i+3] + b"\xFF" for i in range(0, len(self.palette), 3)]
+            return b"".join(map(palette.__getitem__, rgba))
 
-        if len(pixel) == 1:
+        # Otherwise spread the channels out across every 4th byte
+        rval = bytearray(n * 4)
+        if self.num_channels == 1:
             # assume they meant grayscale
-            pixel.append(pixel[0])
-            pixel.append(pixel[0])
-            pixel.append(255)
-        elif len(pixel) == 2:
+            rval[0::4] = rgba
+            rval[1::4] = rgba
+            rval[2::4] = rgba
+            rval[3::4] = opaque
+        elif self.num_channels == 2:
             # Only the RA format yields 2 channels
-            pixel = bytearray([pixel[0], pixel[0], pixel[0], pixel[1]])
-        elif len(pixel) == 3:
+            rval[0::4] = rgba[0::2]
+            rval[1::4] = rgba[0::2]
+            rval[2::4] = rgba[0::2]
+            rval[3::4] = rgba[1::2]
+        elif self.num_channels == 3:
             # Only the RGB format yields 3 channels
-            pixel.append(255)
+            rval[0::4] = rgba[0::3]
+            rval[1::4] = rgba[1::3]
+            rval[2::4] = rgba[2::3]
+            rval[3::4] = opaque
             # Note, there could have been a whole bunch of ancillary chunks
             # concerning keyed transparency, gamma, etc, which we have promptly ignored.
-        # RGBA yields 4 channels; the others were appropriately padded
+        else:
+            # RGBA is already RGBA
+            rval[:] = rgba
+        return bytes(rval)
+
+    def get(self, x, y):
+        """
+        Retrieve the RGBA8 values at x x y.
+
+        Returns tuple(r, g, b, a)
+
+        Check this.w and this.h for size
+        """
+        # Convert the whole image the first time a pixel is asked for;
+        # after that every pixel is just 4 bytes at a known offset
+        if self.rgba8 is None:
+            self.rgba8 = self.to_rgba8()
+        start = (y * self.w + x) * 4
+        pixel = self.rgba8[start:start+4]
         return (pixel[0], pixel[1], pixel[2], pixel[3])
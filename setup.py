@@ -0,0 +1,18 @@
+"""
+basicpng itself is a single pure Python file; you don't need to build or
+install anything to use it.
+
+This only exists to build the optional _basicpng_filters C extension, which
+basicpng picks up if it's there:
+
+    python setup.py build_ext --inplace
+"""
+from setuptools import setup, Extension
+
+setup(
+    name="basicpng",
+    py_modules=["basicpng"],
+    ext_modules=[
+        Extension("_basicpng_filters", ["_basicpng_filters.c"], optional=True),
+    ],
+)
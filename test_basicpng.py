@@ -0,0 +1,262 @@
+# Copyright (c) 2024, Vlad Meșco
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Tests for basicpng.
+
+There's no Pillow around to produce reference images, so this file carries
+its own tiny PNG encoder (zlib, struct and crc32 are all it needs). It can
+write every color type and bit depth with any filter on any row, which the
+decoder then has to get back to the exact same pixels, whichever of its
+filter implementations (C, numba or Python) is in use.
+
+Run with `python -m unittest` (or pytest).
+"""
+import itertools
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+import basicpng
+
+# color type: number of channels
+CHANNELS = {
+    0: 1,
+    2: 3,
+    3: 1,
+    4: 2,
+    6: 4
+}
+
+# every color type with every bit depth it allows
+FORMATS = [
+    (0, 1), (0, 2), (0, 4), (0, 8), (0, 16),
+    (2, 8), (2, 16),
+    (3, 1), (3, 2), (3, 4), (3, 8),
+    (4, 8), (4, 16),
+    (6, 8), (6, 16),
+]
+
+def Chunk(cht, chd):
+    """A PNG chunk: u32be size, u8[4] id, data, u32be crc32 of id + data"""
+    return struct.pack(">I", len(chd)) + cht + chd + struct.pack(">I", zlib.crc32(cht + chd) & 0xFFFFFFFF)
+
+def PackRow(samples, bit_depth):
+    """Packs one row of samples into bytes, padding the last byte with 0s"""
+    if bit_depth == 16:
+        return b"".join(struct.pack(">H", s) for s in samples)
+    if bit_depth == 8:
+        return bytes(samples)
+    per_byte = 8 // bit_depth
+    rval = bytearray()
+    for i in range(0, len(samples), per_byte):
+        group = samples[i:i+per_byte]
+        group = group + [0] * (per_byte - len(group))
+        bb = 0
+        for s in group:
+            bb = (bb << bit_depth) | s
+        rval.append(bb)
+    return bytes(rval)
+
+def FilterRow(raw, prior, bpp, filter_type):
+    """Applies PNG filter filter_type to raw, given the raw row above it"""
+    rval = bytearray([filter_type])
+    for i, x in enumerate(raw):
+        a = raw[i - bpp] if i >= bpp else 0
+        b = prior[i]
+        c = prior[i - bpp] if i >= bpp else 0
+        predictor = [0, a, b, (a + b) // 2, basicpng.PaethPredictor(a, b, c)][filter_type]
+        rval.append((x - predictor) % 256)
+    return rval
+
+def EncodePng(w, h, color_type, bit_depth, samples, palette, filters, num_idat=1):
+    """
+    Encodes samples (w * h * channels of them, row by row) as a PNG, using
+    filters[j] on row j and splitting the deflate stream into num_idat IDATs.
+    An ancillary chunk is thrown in for good measure; it must be ignored.
+    """
+    nc = CHANNELS[color_type]
+    bpp = max(1, nc * bit_depth // 8)
+    filtered = bytearray()
+    prior = None
+    for j in range(0, h):
+        raw = PackRow(samples[j * w * nc:(j + 1) * w * nc], bit_depth)
+        if prior is None:
+            prior = bytes(len(raw))
+        filtered += FilterRow(raw, prior, bpp, filters[j])
+        prior = raw
+    compressed = zlib.compress(bytes(filtered))
+
+    png = bytes([137, 80, 78, 71, 13, 10, 26, 10])
+    png += Chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, bit_depth, color_type, 0, 0, 0))
+    png += Chunk(b"tEXt", b"Comment\x00basicpng")
+    if palette is not None:
+        png += Chunk(b"PLTE", bytes(itertools.chain(*palette)))
+    step = len(compressed) // num_idat + 1
+    for i in range(0, len(compressed), step):
+        png += Chunk(b"IDAT", compressed[i:i+step])
+    png += Chunk(b"IEND", b"")
+    return png
+
+def ExpectedRgba8(color_type, bit_depth, samples, palette):
+    """What PngDecode.get should say for each pixel, as a list of tuples"""
+    nc = CHANNELS[color_type]
+    rval = []
+    for i in range(0, len(samples), nc):
+        s = samples[i:i+nc]
+        if color_type == 3:
+            rval.append(tuple(palette[s[0]]) + (255,))
+            continue
+        if bit_depth == 16:
+            # the high byte, rounded by the low byte
+            s = [min(255, (x >> 8) + ((x & 0xFF) >= 128)) for x in s]
+        elif bit_depth < 8:
+            # scaled to fill 0..255
+            s = [x * 255 // ((1 << bit_depth) - 1) for x in s]
+        if color_type == 0:
+            rval.append((s[0], s[0], s[0], 255))
+        elif color_type == 2:
+            rval.append((s[0], s[1], s[2], 255))
+        elif color_type == 4:
+            rval.append((s[0], s[0], s[0], s[1]))
+        else:
+            rval.append(tuple(s))
+    return rval
+
+def RandomImage(rnd, w, h, color_type, bit_depth):
+    """Returns (samples, palette) for a random w x h image"""
+    if color_type == 3:
+        size = rnd.randint(1, 1 << bit_depth)
+        palette = [(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(0, size)]
+        return [rnd.randrange(size) for _ in range(0, w * h)], palette
+    maximum = (1 << bit_depth) - 1
+    return [rnd.randint(0, maximum) for _ in range(0, w * h * CHANNELS[color_type])], None
+
+# Which filter implementations to check. Python always works; the others are
+# only there if they got built / installed.
+BACKENDS = [("python", {"_basicpng_filters": None, "numba": None})]
+if basicpng._basicpng_filters is not None:
+    BACKENDS.append(("c", {"numba": None}))
+if basicpng.numba is not None:
+    BACKENDS.append(("numba", {"_basicpng_filters": None}))
+
+class TestPngDecode(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(1)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, "test.png")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def Decode(self, png, backend_patches):
+        """Decodes png with some of basicpng's optional modules knocked out"""
+        with open(self.fname, "wb") as f:
+            f.write(png)
+        with mock.patch.dict(basicpng.__dict__, backend_patches):
+            return basicpng.PngDecode(self.fname)
+
+    def CheckRoundTrip(self, w, h, color_type, bit_depth, filters, num_idat=1):
+        samples, palette = RandomImage(self.rnd, w, h, color_type, bit_depth)
+        png = EncodePng(w, h, color_type, bit_depth, samples, palette, filters, num_idat)
+        expected = ExpectedRgba8(color_type, bit_depth, samples, palette)
+        for backend, patches in BACKENDS:
+            with self.subTest(backend=backend):
+                D = self.Decode(png, patches)
+                self.assertEqual((D.w, D.h), (w, h))
+                self.assertEqual(D.to_rgba8(), bytes(itertools.chain(*expected)))
+                self.assertEqual([D.get(x, y) for y in range(0, h) for x in range(0, w)], expected)
+
+    def test_every_format_with_every_filter(self):
+        # Odd widths make sure sub-byte rows with padding bits work out
+        for color_type, bit_depth in FORMATS:
+            for filter_type in range(0, 5):
+                for w in (1, 3, 8, 13):
+                    with self.subTest(color_type=color_type, bit_depth=bit_depth, filter_type=filter_type, w=w):
+                        self.CheckRoundTrip(w, 4, color_type, bit_depth, [filter_type] * 4)
+
+    def test_mixed_filters_and_many_idat_chunks(self):
+        for color_type, bit_depth in FORMATS:
+            for num_idat in (1, 2, 5):
+                w = self.rnd.randint(1, 23)
+                h = self.rnd.randint(1, 9)
+                filters = [self.rnd.randint(0, 4) for _ in range(0, h)]
+                with self.subTest(color_type=color_type, bit_depth=bit_depth, w=w, h=h, filters=filters, num_idat=num_idat):
+                    self.CheckRoundTrip(w, h, color_type, bit_depth, filters, num_idat)
+
+    def test_tall_image_in_one_idat(self):
+        # Optimizers like to put everything in a single huge IDAT; that has
+        # to stream through zlib many rows at a time, in many slices
+        w, h = 16, 20000
+        samples = [self.rnd.randrange(4) for _ in range(0, w * h)]
+        png = EncodePng(w, h, 0, 8, samples, None, [0] * h)
+        expected = bytes(itertools.chain(*ExpectedRgba8(0, 8, samples, None)))
+        self.assertEqual(self.Decode(png, {"deflate": None}).to_rgba8(), expected)
+
+    def test_full_palette(self):
+        # PLTE may hold all 256 entries
+        w, h = 16, 16
+        samples = list(range(0, 256))
+        palette = [(i, 255 - i, i // 2) for i in range(0, 256)]
+        png = EncodePng(w, h, 3, 8, samples, palette, [0] * h)
+        D = self.Decode(png, {})
+        self.assertEqual(D.get(15, 15), (255, 0, 127, 255))
+
+    @unittest.skipIf(basicpng.deflate is None, "deflate (libdeflate) is not installed")
+    def test_libdeflate_matches_zlib(self):
+        samples, _ = RandomImage(self.rnd, 17, 5, 6, 8)
+        png = EncodePng(17, 5, 6, 8, samples, None, [0, 1, 2, 3, 4], 3)
+        expected = bytes(itertools.chain(*ExpectedRgba8(6, 8, samples, None)))
+        self.assertEqual(self.Decode(png, {"deflate": None}).to_rgba8(), expected)
+        self.assertEqual(self.Decode(png, {}).to_rgba8(), expected)
+
+    def test_truncated_image_data(self):
+        # Cut the deflate stream short, and separately drop the last byte of
+        # the last scanline; neither may pass for a (partly black) image
+        w, h = 9, 6
+        samples, _ = RandomImage(self.rnd, w, h, 2, 8)
+        png = EncodePng(w, h, 2, 8, samples, None, [1] * h)
+        idat = png.index(b"IDAT")
+        size = int.from_bytes(png[idat-4:idat], "big")
+        compressed = png[idat+4:idat+4+size]
+        filtered = zlib.decompress(compressed)
+        broken = [
+            compressed[:len(compressed) // 2],
+            zlib.compress(filtered[:-1]),
+        ]
+        for i, data in enumerate(broken):
+            png2 = png[:idat-4] + Chunk(b"IDAT", data) + Chunk(b"IEND", b"")
+            for patches in ({"deflate": None}, {}):
+                with self.subTest(case=i, zlib_only=bool(patches)):
+                    with self.assertRaises(Exception):
+                        self.Decode(png2, patches)
+
+    def test_not_a_png(self):
+        with self.assertRaises(Exception):
+            self.Decode(b"GIF89a..", {})
+
+if __name__ == "__main__":
+    unittest.main()